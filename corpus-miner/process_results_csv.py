@@ -1,8 +1,13 @@
 import pandas as pd
 import argparse
 import sys
+import importlib.util
 from tree_logic import build_phrase_tree, generate_html_tree
 
+# The pyarrow CSV reader is multithreaded and parses much faster; it is optional,
+# so the default C engine is used when pyarrow is not installed
+CSV_ENGINE = 'pyarrow' if importlib.util.find_spec('pyarrow') is not None else 'c'
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--input", default="results_max.csv", help="Input CSV file")
@@ -11,6 +16,7 @@ def main():
     # New parameters
     parser.add_argument("--min_l", type=int, default=0, help="Minimum phrase length")
     parser.add_argument("--min_f", type=int, default=0, help="Minimum frequency (doc count)")
+    parser.add_argument("--jobs", type=int, default=1, help="Worker processes for parent linking (-1 = all cores)")
     args = parser.parse_args()
 
     encodings_to_try = ['utf-8-sig', 'utf-16', 'utf-16le', 'utf-16be', 'latin-1']
@@ -19,8 +25,8 @@ def main():
     for enc in encodings_to_try:
         try:
             # We use engine='python' occasionally for better error handling with encodings,
-            # but the default C engine is usually fine if the encoding is correct.
-            df = pd.read_csv(args.input, encoding=enc)
+            # but the C or pyarrow engine is usually fine if the encoding is correct.
+            df = pd.read_csv(args.input, encoding=enc, engine=CSV_ENGINE)
             print(f"Successfully loaded using {enc} encoding.")
             break
         except (UnicodeDecodeError, UnicodeError):
@@ -50,7 +56,7 @@ def main():
         return
 
     print(f"Building hierarchy for {len(df)} sequences...")
-    tree_df = build_phrase_tree(df)
+    tree_df = build_phrase_tree(df, n_jobs=args.jobs)
 
     print(f"Saving enriched CSV to {args.output}...")
     tree_df.to_csv(args.output, index=False, encoding='utf-8')
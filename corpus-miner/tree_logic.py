@@ -3,117 +3,253 @@ from tqdm import tqdm
 import json
 import numpy as np
 import re
+import os
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 
-def normalize_phrase(p):
-    """Normalize whitespace and case for consistent lookups."""
-    return " ".join(str(p).lower().strip().split())
+# Optional faster JSON encoders; the stdlib json module is the fallback
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
-def build_phrase_tree(df):
+def dumps_json(obj):
+    """Serializes obj to UTF-8 JSON bytes using the fastest encoder available."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    if ujson is not None:
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+def tokenize_phrase(p):
+    """Lower-case a phrase and split it into its word tuple (normalizes whitespace)."""
+    return tuple(str(p).lower().split())
+
+def build_parent_index(words_tuples):
+    """
+    Buckets the phrases that can be a parent by word count: {word count: {word-id tuple: row index}}.
+    Only counts of at least two words and shorter than the longest phrase are kept.
+    """
+    max_len = max((len(wt) for wt in words_tuples), default=0)
+    by_wc = {}
+    for i, wt in enumerate(words_tuples):
+        if 2 <= len(wt) < max_len:
+            by_wc.setdefault(len(wt), {})[wt] = i
+    return by_wc
+
+def find_best_parent(by_wc, wt):
+    """Returns the row index of the longest suffix or prefix parent of 'wt' (suffix first), or None."""
+    l = len(wt)
+    for target_len in range(l - 1, 1, -1):
+        bucket = by_wc.get(target_len)
+        if bucket is None:
+            continue
+        drop = l - target_len
+        p_idx = bucket.get(wt[drop:])
+        if p_idx is None:
+            p_idx = bucket.get(wt[:-drop])
+        if p_idx is not None:
+            return p_idx
+    return None
+
+# Inherited by forked link workers instead of being pickled per task
+LINK_STATE = None
+
+def find_parents_in_range(bounds):
+    """Worker task: best parents for rows [start, stop) of LINK_STATE."""
+    words_tuples, by_wc = LINK_STATE
+    start, stop = bounds
+    return [find_best_parent(by_wc, words_tuples[i]) for i in range(start, stop)]
+
+def link_parents(words_tuples, n_jobs=1):
+    """
+    Finds the longest prefix or suffix parent (>= 2 words) of every phrase.
+    Works on plain tuples and ints only; returns (parent_ids, levels) lists.
+    Expects phrases sorted by length so that parents are linked before their children.
+    n_jobs > 1 (or -1 for all cores) fans the lookups out to forked worker processes.
+    """
+    global LINK_STATE
+    n = len(words_tuples)
+    by_wc = build_parent_index(words_tuples)
+
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+
+    print("Linking Parents...")
+    if n_jobs > 1 and 'fork' in mp.get_all_start_methods():
+        # Each row's lookup is independent; rows are split into contiguous chunks
+        chunk = max(1, -(-n // (n_jobs * 8)))
+        bounds = [(start, min(start + chunk, n)) for start in range(0, n, chunk)]
+        LINK_STATE = (words_tuples, by_wc)
+        try:
+            with ProcessPoolExecutor(n_jobs, mp_context=mp.get_context('fork')) as pool:
+                parts = tqdm(pool.map(find_parents_in_range, bounds), total=len(bounds), desc="Linking")
+                parent_ids = [p for part in parts for p in part]
+        finally:
+            LINK_STATE = None
+    else:
+        # Refresh the bar at most every 1% / 0.5s so it stays negligible next to the lookups
+        progress = tqdm(words_tuples, desc="Linking", mininterval=0.5, miniters=max(1, n // 100))
+        parent_ids = [find_best_parent(by_wc, wt) for wt in progress]
+
+    # Levels need the parent's level, so they are filled serially in length order
+    levels = [0] * n
+    for i, p_idx in enumerate(parent_ids):
+        if p_idx is not None:
+            levels[i] = levels[p_idx] + 1
+
+    return parent_ids, levels
+
+def build_phrase_tree(df, n_jobs=1):
     """
     Standard tree building logic.
     Finds the 'longest existing' parent for each phrase (prefix or suffix).
     """
-    df['phrase'] = df['phrase'].apply(normalize_phrase)
-    df = df.sort_values('length').reset_index(drop=True)
+    # Tokenize once; the normalized phrase, its length and the index keys all derive from it
+    words = [tokenize_phrase(p) for p in df['phrase'].tolist()]
+    df['phrase'] = [" ".join(ws) for ws in words]
+
+    # Words are interned to small ints so the per-phrase word strings can be freed
+    vocab = {}
+    intern = vocab.setdefault
+    token_lists = [tuple([intern(w, len(vocab)) for w in ws]) for ws in words]
+    del words
+    if 'length' not in df.columns:
+        df['length'] = [len(t) for t in token_lists]
+
+    # Stable order keeps equal-length rows in input order, so ids are reproducible
+    order = np.argsort(df['length'].to_numpy(), kind='stable')
+    df = df.iloc[order].reset_index(drop=True)
     df['id'] = df.index
-    df['parent_id'] = None
-    df['level'] = 0
+    token_lists = [token_lists[j] for j in order]
 
-    phrase_to_id = {row.phrase: i for i, row in df.iterrows()}
+    phrases_list = df['phrase'].tolist()
+    parent_ids, levels = link_parents(token_lists, n_jobs)
 
-    print("Linking Parents...")
-    for i in tqdm(range(len(df)), desc="Linking"):
-        words = df.iloc[i].phrase.split()
-        l = len(words)
-        found = False
-
-        # Search for the longest available parent in the dataset
-        for drop in range(1, l - 1):
-            suffix = " ".join(words[drop:])
-            prefix = " ".join(words[:-drop])
-
-            for potential_parent in [suffix, prefix]:
-                if potential_parent in phrase_to_id:
-                    p_idx = phrase_to_id[potential_parent]
-                    df.at[i, 'parent_id'] = int(p_idx)
-                    df.at[i, 'level'] = int(df.at[p_idx, 'level']) + 1
-                    found = True
-                    break
-            if found: break
+    df['parent_id'] = pd.Series(parent_ids, index=df.index, dtype=object)
+    df['level'] = levels
+
+    # Display phrases are resolved in one pass once all parents are known
+    df['display_phrase'] = [
+        " ".join(p.replace(phrases_list[pid], " <PARENT> ").split()) if pid is not None else p
+        for p, pid in zip(phrases_list, parent_ids)
+    ]
 
     return df
 
-def compress_unbranched_branches(nodes, parent_phrase=None):
+def compress_unbranched_branches(nodes, children_idx, phrases, displays, emit, parent=None):
     """
     Recursive function to collapse 'ladders'.
     If a node leads to exactly one child, it skips to the end of that
     chain (the longest variant) or to the first branching point.
+    Nodes are row positions; emit(pos, display, parent_pos) builds one flat output record.
     """
     compressed = []
+    parent_phrase = phrases[parent] if parent is not None else None
 
     for node in nodes:
         curr = node
 
         # 1. Skip nodes that have exactly one child (the 'ladder')
         # This moves 'curr' to the longest variant in the unbranched path
-        while len(curr['children']) == 1:
-            curr = curr['children'][0]
+        while len(children_idx[curr]) == 1:
+            curr = children_idx[curr][0]
 
         # 2. Update the display phrase for the new representative node
         # It must be relative to the parent ABOVE the entire collapsed chain
-        if parent_phrase and parent_phrase in curr['phrase']:
+        phrase = phrases[curr]
+        if curr == node and displays is not None:
+            # Nothing was collapsed: the precomputed display is already relative to it
+            display = displays[curr]
+        elif parent_phrase and parent_phrase in phrase:
             # Replace the parent part with <PARENT>
-            display = curr['phrase'].replace(parent_phrase, " <PARENT> ")
-            curr['display_phrase'] = " ".join(display.split())
+            display = " ".join(phrase.replace(parent_phrase, " <PARENT> ").split())
         else:
             # If it's a root node, show the full phrase
-            curr['display_phrase'] = curr['phrase']
+            display = phrase
+
+        compressed.append(emit(curr, display, parent))
 
         # 3. Recursively process children of the promoted node
-        if curr['children']:
+        if children_idx[curr]:
             # The new 'curr' is now the parent for its children
-            curr['children'] = compress_unbranched_branches(curr['children'], curr['phrase'])
-
-        compressed.append(curr)
+            compressed.extend(compress_unbranched_branches(children_idx[curr], children_idx, phrases, displays, emit, curr))
 
     return compressed
 
 def generate_html_tree(df, output_file="tree_view.html", max_nodes=15000):
     """Generates a collapsible HTML tree view with compression logic applied."""
 
-    if 'score' not in df.columns:
-        max_l, max_f = df['length'].max(), df['freq'].max()
-        df['score'] = np.sqrt((1 - df['length']/max_l)**2 + (1 - np.log1p(df['freq'])/np.log1p(max_f))**2)
+    if 'score' in df.columns:
+        score = df['score'].to_numpy(dtype=np.float64)
+    elif df.empty:
+        # Nothing to rank; the page is still written, just with no nodes
+        score = np.empty(0, dtype=np.float64)
+    else:
+        L = df['length'].to_numpy(dtype=np.float64)
+        F = np.log1p(df['freq'].to_numpy(dtype=np.float64))
+        # nanmax skips missing counts the way pandas' max() did
+        score = np.sqrt((1 - L / np.nanmax(L))**2 + (1 - F / np.nanmax(F))**2)
+
     # 1. Select top nodes and ensure parent integrity (all ancestors included)
-    top_df = df.sort_values('score').head(max_nodes)
-    all_visible_ids = set(top_df['id'].tolist())
+    # argpartition picks the max_nodes lowest scores without sorting every row
+    if max_nodes < len(score):
+        top_positions = np.argpartition(score, max_nodes)[:max_nodes]
+    else:
+        top_positions = np.arange(len(score))
+
+    # Walk ancestor chains over integer positions; a chain stops at the first visible node
+    id_to_pos = {int(id_val): pos for pos, id_val in enumerate(df['id'].tolist())}
+    parent_arr = np.array([-1 if p is None else id_to_pos[int(p)] for p in df['parent_id'].tolist()], dtype=np.int64)
+    visible = np.zeros(len(df), dtype=bool)
+    visible[top_positions] = True
 
-    for _, row in top_df.iterrows():
-        curr_p = row['parent_id']
-        while curr_p is not None:
-            p_val = int(curr_p)
-            if p_val in all_visible_ids: break
-            all_visible_ids.add(p_val)
-            curr_p = df.at[p_val, 'parent_id']
+    for pos in top_positions:
+        p = parent_arr[pos]
+        while p != -1 and not visible[p]:
+            visible[p] = True
+            p = parent_arr[p]
 
-    final_viz_df = df[df['id'].isin(all_visible_ids)].copy()
+    # iloc already returns a new frame and it is only read below, so no extra copy
+    final_viz_df = df.iloc[np.flatnonzero(visible)]
 
-    # 2. Build the JSON Tree structure
-    nodes_dict = final_viz_df.to_dict('records')
-    id_map = {int(n['id']): n for n in nodes_dict}
-    for n in nodes_dict: n['children'] = []
+    # 2. Link children by row position over column arrays; records are only built on emit
+    ids = final_viz_df['id'].tolist()
+    freqs = final_viz_df['freq'].tolist()
+    lengths = final_viz_df['length'].tolist()
+    phrases = final_viz_df['phrase'].tolist()
+    displays = final_viz_df['display_phrase'].tolist() if 'display_phrase' in final_viz_df.columns else None
+    pos_of_id = {int(id_val): i for i, id_val in enumerate(ids)}
+    children_idx = [[] for _ in phrases]
 
+    # One groupby pass yields every parent's child positions (in row order)
+    groups = final_viz_df.groupby('parent_id', dropna=False, sort=False).indices
     raw_tree = []
-    for n in nodes_dict:
-        p_id = n.get('parent_id')
-        if p_id is None or int(p_id) not in id_map:
-            raw_tree.append(n)
+    for p_id, child_pos in groups.items():
+        parent_pos = None if pd.isna(p_id) else pos_of_id.get(int(p_id))
+        if parent_pos is None:
+            raw_tree.extend(child_pos.tolist())
         else:
-            id_map[int(p_id)]['children'].append(n)
+            children_idx[parent_pos] = child_pos.tolist()
+    raw_tree.sort()
+
+    def emit(i, display, parent):
+        # parent_id points at the compressed parent, so the page can rebuild the tree in one pass
+        return {
+            'id': ids[i],
+            'parent_id': ids[parent] if parent is not None else None,
+            'freq': freqs[i],
+            'length': lengths[i],
+            'display_phrase': display,
+        }
 
-    # 3. Apply the compression logic to remove unbranched chains
+    # 3. Apply the compression logic to remove unbranched chains; the result is a flat list
     print("Compressing unbranched paths...")
-    final_tree = compress_unbranched_branches(raw_tree)
+    final_tree = compress_unbranched_branches(raw_tree, children_idx, phrases, displays, emit)
 
     # 4. Generate the HTML (Template remains standard)
     html_template = """
@@ -169,12 +305,22 @@ def generate_html_tree(df, output_file="tree_view.html", max_nodes=15000):
                 }
                 return li;
             }
+            const byId = {};
+            data.forEach(n => { n.children = []; byId[n.id] = n; });
+            const roots = [];
+            data.forEach(n => {
+                (n.parent_id != null && byId[n.parent_id]) ? byId[n.parent_id].children.push(n) : roots.push(n);
+            });
             const root = document.createElement('ul');
-            data.sort((a,b) => b.freq - a.freq).forEach(d => root.appendChild(createNode(d)));
+            roots.sort((a,b) => b.freq - a.freq).forEach(d => root.appendChild(createNode(d)));
             document.getElementById('tree').appendChild(root);
         </script>
     </body>
     </html>
     """
-    with open(output_file, "w", encoding="utf-8") as f:
-        f.write(html_template.replace("%DATA%", json.dumps(final_tree, ensure_ascii=False)))
\ No newline at end of file
+    # Write the encoded template halves around the JSON bytes; no full-page str is built
+    before, after = html_template.encode('utf-8').split(b"%DATA%")
+    with open(output_file, "wb") as f:
+        f.write(before)
+        f.write(dumps_json(final_tree))
+        f.write(after)
\ No newline at end of file